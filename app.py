@@ -4,17 +4,37 @@
 from __future__ import annotations
 import os
 import re
-import json
+import hashlib
+import shutil
+import functools
 import tempfile
-import subprocess
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from itertools import chain, zip_longest
 from datetime import datetime, timezone
 from pathlib import Path
 
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, Response, request, send_file, render_template
 import anthropic
+import orjson
+from yt_dlp import YoutubeDL
 
 app = Flask(__name__)
 
+# On-disk cache: URL → subtitle text/title, and subtitle text → Claude result
+_CACHE_DIR = Path(tempfile.gettempdir()) / "animejapanese_cache"
+
+# Shared keep-alive HTTP pool for Claude calls (gevent-patched sockets under wsgi.py)
+_http_client = anthropic.DefaultHttpxClient()
+
+# Inline cue tags (<c>, <i>, <00:00:00.000>), compiled once at import time
+_TAG_RE = re.compile(r"<[^>]+>")
+# Word-timing / <c> tags only YouTube auto captions use
+_AUTO_CAPTION_TAG_RE = re.compile(r"<\d{2}:\d{2}[:.\d]*>|</?c[.>]")
+
 SYSTEM_PROMPT_ANIME = """你是日文學習助手，專門從日本動漫對白中選取適合 N2 程度以上的學習素材。
 
 請從以下動漫字幕中：
@@ -70,129 +90,426 @@ def get_api_key(request_body=None):
     return key
 
 
+def _resolve_ffmpeg() -> str | None:
+    """Locate ffmpeg once at startup; it is only needed to convert non-VTT subtitles."""
+    path = shutil.which("ffmpeg")
+    if not path:
+        app.logger.warning("ffmpeg not found; subtitles will be used in the format YouTube serves")
+    return path
+
+
+_FFMPEG_BIN = _resolve_ffmpeg()
+
+# Per-request options only add the output template
+_YDL_OPTS = {
+    "skip_download": True,
+    "writesubtitles": True,
+    "writeautomaticsub": True,  # yt-dlp picks official subs over auto when both exist
+    "subtitleslangs": ["ja"],
+    "subtitlesformat": "vtt/best",
+    "noplaylist": True,       # only download the specific video, not entire playlist
+    "cookiesfrombrowser": ("chrome",),
+    "socket_timeout": 60,
+    "quiet": True,
+    "no_warnings": True,
+}
+if _FFMPEG_BIN:
+    _YDL_OPTS["ffmpeg_location"] = _FFMPEG_BIN
+    _YDL_OPTS["postprocessors"] = [
+        {"key": "FFmpegSubtitlesConvertor", "format": "vtt", "when": "before_dl"},
+    ]
+
+
 def download_subtitles(url: str, tmpdir: str) -> tuple[str | None, str | None]:
     """
     Try to download Japanese subtitles. Returns (subtitle_text, video_title) or (None, None).
-    Tries official subs first, then auto-generated.
+    Prefers official subs, falls back to auto-generated.
     """
-    # Use %(title)s so the filename contains the video title
-    base_path = os.path.join(tmpdir, "%(title)s")
-
-    # Use Python 3.9 yt-dlp (Homebrew 2026.x has JS runtime issues with YouTube)
-    import shutil
-    ytdlp_bin = "/Users/ivyma/Library/Python/3.9/bin/yt-dlp"
-    if not Path(ytdlp_bin).exists():
-        ytdlp_bin = shutil.which("yt-dlp") or "yt-dlp"
-
-    # Common yt-dlp args (no --print title — it prevents subtitle file creation)
-    common_args = [
-        ytdlp_bin,
-        "--skip-download",
-        "--sub-lang", "ja",
-        "--convert-subs", "vtt",
-        "-o", base_path,
-        "--no-warnings",
-        "--no-playlist",          # only download the specific video, not entire playlist
-        "--cookies-from-browser", "chrome",
-    ]
+    ydl_opts = {**_YDL_OPTS, "outtmpl": os.path.join(tmpdir, "%(title)s")}
 
-    def run_and_check(extra_args):
-        """Run yt-dlp, return (subtitle_text, title) or (None, None)."""
-        try:
-            subprocess.run(common_args + extra_args + [url],
-                capture_output=True, text=True, timeout=60)
-            vtt_files = list(Path(tmpdir).glob("*.vtt"))
-            if vtt_files:
-                # Extract title from filename: "Title.ja.vtt" → "Title"
-                stem = vtt_files[0].stem  # e.g. "葬送的芙莉蓮 第29話.ja"
-                title = stem.rsplit(".", 1)[0] if "." in stem else stem
-                return parse_subtitle_file(str(vtt_files[0])), title
-        except Exception:
-            pass
+    try:
+        with YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+    except Exception:
         return None, None
 
-    # Try 1: official subs
-    text, title = run_and_check(["--write-sub"])
-    if text:
-        return text, title
+    sub = (info.get("requested_subtitles") or {}).get("ja") or {}
+    filepath = sub.get("filepath")
+    if not filepath or not os.path.exists(filepath):
+        return None, None
+    return parse_subtitle_file(filepath), info.get("title")
+
+
+def parse_subtitle_file(filepath: str) -> str:
+    """Parse VTT or SRT file and return plain text (deduplicated)."""
+    ext = Path(filepath).suffix.lower()
+    is_cue_file = ext in (".vtt", ".srt")
+
+    # dict keeps first-seen order and doubles as the dedup set
+    seen: dict[str, None] = {}
+    last = None
+    is_auto_caption = False
+
+    # utf-8-sig drops a leading BOM so the WEBVTT signature check sees it
+    with open(filepath, "r", encoding="utf-8-sig", errors="replace") as f:
+        lines = f
+        if is_cue_file:
+            first = f.readline()
+            if first.startswith("WEBVTT"):
+                # Skip the header block once; it runs until the first blank line
+                for raw in f:
+                    if not raw.strip():
+                        break
+            else:
+                lines = chain([first], f)
+
+        for raw in lines:
+            line = raw.strip()
+            if is_cue_file:
+                if not line:
+                    continue
+                # Skip timestamps (00:00:00.000 --> ...) and numeric cue IDs;
+                # both start with a digit, so dialogue lines skip the scans
+                if line[0].isdigit() and ("-->" in line or line.isdigit()):
+                    continue
+                # Remove tags like <c>, <00:00:00.000>, <i>
+                if "<" in line:
+                    if not is_auto_caption and _AUTO_CAPTION_TAG_RE.search(line):
+                        is_auto_caption = True
+                    line = _TAG_RE.sub("", line).strip()
+            if not line or line in seen:
+                continue
+            if last is not None and is_auto_caption:
+                # Auto captions grow word by word ("hello" → "hello world"):
+                # keep only the longest line of each cascade
+                if line.startswith(last):
+                    del seen[last]
+                elif last.startswith(line):
+                    continue
+            seen[line] = None
+            last = line
+
+    return "\n".join(seen)
+
+
+class _RateLimiter:
+    """
+    Sliding-window RPM/TPM limiter with a concurrency cap, shared by all Claude calls.
+    Callers wait for a slot instead of hitting a 429. After a 429 the allowed rate is
+    halved (multiplicative decrease) and it creeps back up on each success.
+    """
+    WINDOW = 60.0
+
+    def __init__(self, rpm: int = 50, tpm: int = 80_000, max_concurrent: int = 5):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrent = max_concurrent
+        self.scale = 1.0
+        self._requests = deque()   # request timestamps
+        self._tokens = deque()     # (timestamp, estimated tokens)
+        self._token_total = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def _try_reserve(self, tokens: int) -> float:
+        """Take a slot and return 0, or return how many seconds to wait before retrying."""
+        now = time.monotonic()
+        with self._lock:
+            cutoff = now - self.WINDOW
+            while self._requests and self._requests[0] <= cutoff:
+                self._requests.popleft()
+            while self._tokens and self._tokens[0][0] <= cutoff:
+                self._token_total -= self._tokens.popleft()[1]
+
+            if self._active >= self.max_concurrent:
+                return 0.1
+            if len(self._requests) >= max(1, int(self.rpm * self.scale)):
+                return self._requests[0] + self.WINDOW - now
+            # An oversized request still goes through once the window is empty
+            if self._tokens and self._token_total + tokens > self.tpm * self.scale:
+                return self._tokens[0][0] + self.WINDOW - now
+
+            self._requests.append(now)
+            self._tokens.append((now, tokens))
+            self._token_total += tokens
+            self._active += 1
+            return 0.0
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+
+    @contextmanager
+    def acquire(self, estimated_tokens: int):
+        while (wait := self._try_reserve(estimated_tokens)) > 0:
+            time.sleep(wait)
+        try:
+            yield
+        finally:
+            self._release()
 
-    # Try 2: auto-generated subs
-    text, title = run_and_check(["--write-auto-sub"])
-    if text:
-        return text, title
+    def on_success(self):
+        with self._lock:
+            self.scale = min(1.0, self.scale + 0.05)
 
-    # Try 3: both together
-    text, title = run_and_check(["--write-sub", "--write-auto-sub"])
-    if text:
-        return text, title
+    def on_rate_limited(self):
+        with self._lock:
+            self.scale = max(0.1, self.scale * 0.5)
 
-    return None, None
 
+# Anthropic default tier: 50 requests / 80K tokens per minute
+_limiter = _RateLimiter(rpm=50, tpm=80_000, max_concurrent=5)
 
-def parse_subtitle_file(filepath: str) -> str:
-    """Parse VTT or SRT file and return plain text (deduplicated)."""
-    with open(filepath, "r", encoding="utf-8", errors="replace") as f:
-        content = f.read()
+# Retry delays after a 429: start at 30 s, ×1.5 each time, at most 3 retries
+_RATE_LIMIT_BACKOFF = (30.0, 45.0, 67.5)
 
-    ext = Path(filepath).suffix.lower()
-    lines = []
-
-    if ext == ".vtt":
-        # Remove WEBVTT header and cue settings
-        content = re.sub(r"WEBVTT.*?\n\n", "", content, flags=re.DOTALL)
-        # Remove timestamps (00:00:00.000 --> 00:00:00.000 ...)
-        content = re.sub(r"\d{2}:\d{2}:\d{2}\.\d{3}\s*-->\s*\d{2}:\d{2}:\d{2}\.\d{3}[^\n]*", "", content)
-        # Remove VTT tags like <c>, <00:00:00.000>
-        content = re.sub(r"<[^>]+>", "", content)
-        # Remove cue identifiers (numeric lines)
-        content = re.sub(r"^\d+$", "", content, flags=re.MULTILINE)
-    elif ext == ".srt":
-        # Remove timestamps
-        content = re.sub(r"\d{2}:\d{2}:\d{2},\d{3}\s*-->\s*\d{2}:\d{2}:\d{2},\d{3}", "", content)
-        # Remove numeric cue IDs
-        content = re.sub(r"^\d+$", "", content, flags=re.MULTILINE)
-        # Remove HTML tags
-        content = re.sub(r"<[^>]+>", "", content)
-
-    # Collect non-empty lines, deduplicate consecutive identical lines
-    seen = set()
-    for line in content.splitlines():
-        line = line.strip()
-        if line and line not in seen:
-            seen.add(line)
-            lines.append(line)
-
-    return "\n".join(lines)
 
+# Input budget for the subtitle text sent to Claude
+_MAX_INPUT_TOKENS = 6000
+
+
+def _approx_tokens(text: str) -> float:
+    """Japanese runs at roughly 1.2 characters per token."""
+    return len(text) / 1.2
 
-def call_claude(subtitle_text: str, api_key: str, mode: str = "anime") -> dict:
-    """Send subtitle text to Claude and get learning content JSON."""
-    client = anthropic.Anthropic(api_key=api_key)
 
+def _estimate_tokens(req: dict) -> int:
+    """Input + output token estimate for the limiter, on the same scale as the input budget."""
+    text = "".join(block["text"] for block in req["system"]) + req["messages"][0]["content"]
+    return int(_approx_tokens(text)) + req["max_tokens"]
+
+
+def _fit_subtitle(subtitle_text: str, max_tokens: int = _MAX_INPUT_TOKENS) -> str:
+    """
+    Trim subtitle text to the token budget on line boundaries.
+    When over budget, first drop lines whose character 3-grams are all already
+    seen more than twice, so the budget goes to distinct material.
+    """
+    if _approx_tokens(subtitle_text) <= max_tokens:
+        return subtitle_text
+
+    gram_counts = Counter()
+    kept = []
+    used = 0.0
+    for line in subtitle_text.splitlines():
+        grams = {line[i:i + 3] for i in range(len(line) - 2)} or {line}
+        if all(gram_counts[g] > 2 for g in grams):
+            continue
+        cost = _approx_tokens(line)
+        if used + cost > max_tokens:
+            kept.append("...(字幕截斷)")
+            break
+        gram_counts.update(grams)
+        kept.append(line)
+        used += cost
+    return "\n".join(kept)
+
+
+# Long transcripts are analyzed in overlapping chunks; the cap bounds Claude calls per video
+_CHUNK_OVERLAP_TOKENS = 200
+_MAX_CHUNKS = 4
+_TRUNCATION_NOTE = "\n...(字幕截斷)"
+_MAX_VOCAB = 20
+_MAX_GRAMMAR = 10
+
+
+def _split_by_tokens(text: str, target: int = _MAX_INPUT_TOKENS,
+                     overlap: int = _CHUNK_OVERLAP_TOKENS) -> list[str]:
+    """Split text on line boundaries into chunks of at most ~target tokens."""
+    chunks = []
+    current = []
+    used = 0.0
+    for line in text.splitlines():
+        # Count the joining newline too, so the chunk measures the same as its joined text
+        cost = _approx_tokens(line + "\n")
+        if current and used + cost > target:
+            chunks.append("\n".join(current))
+            # Start the next chunk with this one's tail so boundary cues keep their context
+            tail = []
+            tail_used = 0.0
+            for prev in reversed(current):
+                prev_cost = _approx_tokens(prev + "\n")
+                if tail_used + prev_cost > overlap:
+                    break
+                tail.insert(0, prev)
+                tail_used += prev_cost
+            current, used = tail, tail_used
+        current.append(line)
+        used += cost
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _unique_items(item_lists) -> list[dict]:
+    """Concatenate item lists, keeping the first item for each Japanese text."""
+    merged = {}
+    for items in item_lists:
+        for item in items:
+            if item.get("japanese"):
+                merged.setdefault(item["japanese"], item)
+    return list(merged.values())
+
+
+def _merge_results(results: list[dict], subtitle_text: str, mode: str = "anime") -> dict:
+    """Merge per-chunk Claude results back to one result of the usual size."""
+    vocab = _unique_items(r.get("vocabulary", []) for r in results)
+    # Words the episode uses most are the most worth learning
+    vocab.sort(key=lambda v: -subtitle_text.count(v["japanese"]))
+    merged = {"vocabulary": vocab[:_MAX_VOCAB]}
+
+    if mode == "song":
+        merged["lyrics"] = _unique_items(r.get("lyrics", []) for r in results)
+    else:
+        # Interleave chunks so the sentences span the whole episode
+        grammar = zip_longest(*(r.get("grammar", []) for r in results))
+        merged["grammar"] = _unique_items(
+            [[item for group in grammar for item in group if item]])[:_MAX_GRAMMAR]
+    return merged
+
+
+def _system_blocks(mode: str) -> list[dict]:
+    """System prompt marked for prompt caching, so repeat calls reuse the cached prefix."""
+    prompt = SYSTEM_PROMPT_SONG if mode == "song" else SYSTEM_PROMPT_ANIME
+    return [{"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}]
+
+
+def _claude_request(subtitle_text: str, mode: str = "anime") -> dict:
+    """Build the messages.create kwargs for a subtitle/lyrics analysis."""
     # Limit subtitle length to avoid token overflow
-    max_chars = 8000
-    if len(subtitle_text) > max_chars:
-        subtitle_text = subtitle_text[:max_chars] + "\n...(字幕截斷)"
+    subtitle_text = _fit_subtitle(subtitle_text)
 
     if mode == "song":
-        system = SYSTEM_PROMPT_SONG
         user_msg = f"以下是日文歌曲歌詞：\n\n{subtitle_text}"
     else:
-        system = SYSTEM_PROMPT_ANIME
         user_msg = f"以下是動漫字幕內容：\n\n{subtitle_text}"
 
-    message = client.messages.create(
-        model="claude-sonnet-4-6",
-        max_tokens=4096,
-        system=system,
-        messages=[{"role": "user", "content": user_msg}]
+    return {
+        "model": "claude-sonnet-4-6",
+        "max_tokens": 4096,
+        "system": _system_blocks(mode),
+        "messages": [{"role": "user", "content": user_msg}],
+    }
+
+
+def _claude_batch_request(subtitle_texts: list[str], mode: str = "anime") -> dict:
+    """Build one messages.create request covering several subtitle blocks."""
+    kind = "歌詞" if mode == "song" else "動漫字幕"
+    blocks = "\n".join(
+        f"---BLOCK {i}---\n{_fit_subtitle(text)}" for i, text in enumerate(subtitle_texts)
     )
+    user_msg = (
+        f"以下有 {len(subtitle_texts)} 段{kind}，請對每一段分別依上述要求分析，"
+        '回傳 {"results": [...]}，results[i] 對應 BLOCK i，每項格式與單段相同：\n\n'
+        f"{blocks}"
+    )
+    return {
+        "model": "claude-sonnet-4-6",
+        "max_tokens": 4096 * len(subtitle_texts),
+        "system": _system_blocks(mode),
+        "messages": [{"role": "user", "content": user_msg}],
+    }
 
+
+def _parse_claude_json(message) -> dict:
+    """Extract the JSON payload from a Claude message."""
     text = message.content[0].text.strip()
     # Strip markdown code blocks if present
-    text = re.sub(r"^```(?:json)?\s*", "", text)
-    text = re.sub(r"\s*```$", "", text)
-    return json.loads(text)
+    text = text.removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    return orjson.loads(text)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_client(api_key: str) -> anthropic.Anthropic:
+    """One client per API key, all sharing the keep-alive pool in _http_client."""
+    # SDK retries would bypass _limiter; the backoff loop is the only retry path
+    return anthropic.Anthropic(api_key=api_key, http_client=_http_client, max_retries=0)
+
+
+def call_claude(subtitle_text: str, api_key: str, mode: str = "anime") -> dict:
+    """
+    Send subtitle text to Claude and get learning content JSON.
+    Transcripts over the input budget are split, analyzed in parallel and merged.
+    """
+    if _approx_tokens(subtitle_text) > _MAX_INPUT_TOKENS:
+        return _call_claude_chunked(subtitle_text, api_key, mode)
+    return _call_claude_once(subtitle_text, api_key, mode)
+
+
+def _call_claude_once(subtitle_text: str, api_key: str, mode: str = "anime") -> dict:
+    """One Claude request for a single subtitle block."""
+    message = _create_message(_get_client(api_key), _claude_request(subtitle_text, mode))
+    return _parse_claude_json(message)
+
+
+def call_claude_batch(subtitle_texts: list[str], api_key: str, mode: str = "anime") -> list[dict]:
+    """Analyze several subtitle blocks in one Claude request; results[i] matches block i."""
+    message = _create_message(_get_client(api_key), _claude_batch_request(subtitle_texts, mode))
+    results = _parse_claude_json(message).get("results")
+    if not isinstance(results, list) or len(results) != len(subtitle_texts):
+        raise ValueError(f"Claude 回傳 {len(results or [])} 筆結果，預期 {len(subtitle_texts)} 筆")
+    return results
+
+
+def _create_message(client: anthropic.Anthropic, req: dict):
+    """messages.create through the shared limiter, backing off on 429s."""
+    tokens = _estimate_tokens(req)
+    for delay in (*_RATE_LIMIT_BACKOFF, None):
+        try:
+            with _limiter.acquire(tokens):
+                message = client.messages.create(**req)
+        except anthropic.RateLimitError:
+            _limiter.on_rate_limited()
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        _limiter.on_success()
+        return message
+
+
+def _call_claude_chunked(subtitle_text: str, api_key: str, mode: str = "anime") -> dict:
+    """Analyze chunks in parallel threads, reusing the per-key client and its keep-alive pool."""
+    # Leave room for the truncation note so no chunk goes back through _fit_subtitle's trim
+    chunks = _split_by_tokens(subtitle_text, target=_MAX_INPUT_TOKENS - _approx_tokens(_TRUNCATION_NOTE))
+    if len(chunks) > _MAX_CHUNKS:
+        app.logger.warning("Subtitle split into %d chunks; analyzing only the first %d",
+                           len(chunks), _MAX_CHUNKS)
+        chunks = chunks[:_MAX_CHUNKS]
+        chunks[-1] += _TRUNCATION_NOTE
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        results = list(pool.map(lambda chunk: _call_claude_once(chunk, api_key, mode), chunks))
+    return _merge_results(results, subtitle_text, mode)
+
+
+def _cache_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _cache_path(kind: str, key: str) -> Path:
+    return _CACHE_DIR / f"{kind}-{key}.json"
+
+
+def _cache_load(kind: str, key: str) -> dict | None:
+    """Return a cached JSON object, or None on a miss (or unreadable/non-object entry)."""
+    try:
+        with open(_cache_path(kind, key), "rb") as f:
+            obj = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+def _cache_store(kind: str, key: str, obj: dict) -> bool:
+    """Write a cache entry atomically; caching is best-effort, so errors only return False."""
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=_CACHE_DIR, suffix=".tmp", delete=False) as f:
+            f.write(orjson.dumps(obj))
+        os.replace(f.name, _cache_path(kind, key))
+    except OSError:
+        return False
+    return True
 
 
 def build_nihongocards(title: str, data: dict, mode: str = "anime") -> dict:
@@ -238,6 +555,76 @@ def index():
     return render_template("index.html")
 
 
+def ojsonify(obj) -> Response:
+    """jsonify, but serialized with orjson."""
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+
+def _fetch_subtitles(url: str) -> tuple[str | None, str | None]:
+    """download_subtitles behind the per-URL disk cache."""
+    key = _cache_key(url)
+    cached = _cache_load("subs", key)
+    if cached:
+        return cached["subtitle"], cached["title"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        subtitle_text, video_title = download_subtitles(url, tmpdir)
+    if subtitle_text:
+        _cache_store("subs", key, {"subtitle": subtitle_text, "title": video_title})
+    return subtitle_text, video_title
+
+
+def _claude_error(e: Exception) -> tuple[dict, int]:
+    """Map a Claude call failure to an error body and status code."""
+    if isinstance(e, anthropic.AuthenticationError):
+        return {"error": "API Key 無效，請確認 Anthropic API Key 正確。"}, 401
+    if isinstance(e, anthropic.RateLimitError):
+        return {"error": "API 使用超限，請稍後再試。"}, 429
+    if isinstance(e, orjson.JSONDecodeError):
+        return {"error": f"Claude 回傳格式解析失敗：{str(e)}"}, 500
+    return {"error": f"AI 分析失敗：{str(e)}"}, 500
+
+
+def _safe_filename(title: str) -> str:
+    """Same rule as the frontend's safeName: kana/kanji, ASCII letters/digits, -, _ for spaces."""
+    name = re.sub(r"[^a-zA-Z0-9\u3040-\u9fff\s-]", "", title or "").strip()
+    return re.sub(r"\s+", "_", name)[:60]
+
+
+def _analysis_payload(video_title: str, data: dict, mode: str) -> dict:
+    """Preview fields for the UI; the .nihongocards file itself is served from download_url."""
+    cards = build_nihongocards(video_title, data, mode=mode)
+    payload = {
+        "title": video_title,
+        "mode": mode,
+        "vocabulary": data.get("vocabulary", []),
+        "grammar": data.get("grammar", []),
+        "lyrics": data.get("lyrics", []),
+    }
+    cards_key = _cache_key(mode, video_title or "", orjson.dumps(data).decode("utf-8"))
+    if _cache_store("cards", cards_key, cards):
+        payload["download_url"] = f"/download/{cards_key}.nihongocards"
+    else:
+        # Cache dir not writable: fall back to sending the cards inline
+        payload["nihongocards"] = cards
+    return payload
+
+
+def _validate_request(urls: list, api_key: str):
+    """Return an error response for bad input, or None."""
+    if not urls or not all(isinstance(u, str) and u.strip() for u in urls):
+        return ojsonify({"error": "請提供 YouTube URL"}), 400
+    if not all(u.strip().startswith(("https://", "http://")) for u in urls):
+        return ojsonify({"error": "無效的 URL 格式"}), 400
+    if not api_key:
+        return ojsonify({"error": "請設定 Anthropic API Key（環境變數 ANTHROPIC_API_KEY 或在設定中輸入）"}), 400
+    return None
+
+
+NO_SUBTITLES_ERROR = "找不到日文字幕。請確認該影片有日文字幕（官方或自動生成）。"
+BAD_RESULT_ERROR = "Claude 回傳的結果不是 JSON 物件"
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
     body = request.get_json(silent=True) or {}
@@ -245,45 +632,156 @@ def analyze():
     api_key = get_api_key(body)
     mode = body.get("mode", "anime")  # "anime" or "song"
 
-    if not url:
-        return jsonify({"error": "請提供 YouTube URL"}), 400
-    if not url.startswith(("https://", "http://")):
-        return jsonify({"error": "無效的 URL 格式"}), 400
-    if not api_key:
-        return jsonify({"error": "請設定 Anthropic API Key（環境變數 ANTHROPIC_API_KEY 或在設定中輸入）"}), 400
+    error = _validate_request([url], api_key)
+    if error:
+        return error
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # Step 1: Download subtitles
-        subtitle_text, video_title = download_subtitles(url, tmpdir)
+    # A double-click or retry for the same URL/key/mode waits for the request already running
+    api_key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    try:
+        payload, status = _coalesced(_cache_key(url, api_key_hash, mode),
+                                     lambda: _run_analysis(url, api_key, mode))
+    except FutureTimeoutError:
+        return ojsonify({"error": "分析逾時，請稍後再試。"}), 504
+
+    resp = ojsonify(payload)
+    if status == 200:
+        resp.headers["Cache-Control"] = "no-store"
+    return resp, status
 
-        if not subtitle_text:
-            return jsonify({"error": "找不到日文字幕。請確認該影片有日文字幕（官方或自動生成）。"}), 422
 
-        # Step 2: Call Claude
+def _run_analysis(url: str, api_key: str, mode: str) -> tuple[dict, int]:
+    """The /analyze pipeline; returns (body, status) so coalesced callers can share it."""
+    # Step 1: Download subtitles (cached per URL)
+    subtitle_text, video_title = _fetch_subtitles(url)
+    if not subtitle_text:
+        return {"error": NO_SUBTITLES_ERROR}, 422
+
+    # Step 2: Call Claude (cached per mode + subtitle text)
+    claude_key = _cache_key(mode, subtitle_text)
+    data = _cache_load("claude", claude_key)
+    if data is None:
         try:
             data = call_claude(subtitle_text, api_key, mode=mode)
-        except anthropic.AuthenticationError:
-            return jsonify({"error": "API Key 無效，請確認 Anthropic API Key 正確。"}), 401
-        except anthropic.RateLimitError:
-            return jsonify({"error": "API 使用超限，請稍後再試。"}), 429
-        except json.JSONDecodeError as e:
-            return jsonify({"error": f"Claude 回傳格式解析失敗：{str(e)}"}), 500
         except Exception as e:
-            return jsonify({"error": f"AI 分析失敗：{str(e)}"}), 500
-
-        # Step 3: Build nihongocards
-        cards = build_nihongocards(video_title, data, mode=mode)
-
-        resp = jsonify({
-            "title": video_title,
-            "mode": mode,
-            "vocabulary": data.get("vocabulary", []),
-            "grammar": data.get("grammar", []),
-            "lyrics": data.get("lyrics", []),
-            "nihongocards": cards
-        })
-        resp.headers["Cache-Control"] = "no-store"
-        return resp
+            return _claude_error(e)
+        # Only cache well-formed results, so a bad reply is retried next time
+        if not isinstance(data, dict):
+            return _claude_error(ValueError(BAD_RESULT_ERROR))
+        _cache_store("claude", claude_key, data)
+
+    # Step 3: Build nihongocards
+    return _analysis_payload(video_title, data, mode), 200
+
+
+# In-flight /analyze work by request key; entries only live while the leader runs
+_inflight: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+# Longer than the worst-case rate-limit backoff, so followers don't give up on a live leader
+_INFLIGHT_TIMEOUT = 300
+
+
+def _coalesced(key: str, fn):
+    """Run fn once per key at a time; concurrent callers with the same key get its result."""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[key] = Future()
+
+    if not is_leader:
+        return future.result(timeout=_INFLIGHT_TIMEOUT)
+
+    try:
+        result = fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+# Batch output is capped at 4096 tokens per video, so keep batches small
+MAX_BATCH_URLS = 5
+
+
+def _analyze_batch(urls: list[str], api_key: str, mode: str) -> list[dict]:
+    """Download all subtitles concurrently, then analyze the uncached ones in one Claude call."""
+    # Threads rather than asyncio.run: under gevent every request shares one OS thread,
+    # so a second concurrent batch would find the first one's event loop already running
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        subs = list(pool.map(_fetch_subtitles, urls))
+
+    # Batch blocks are trimmed to the input budget, so their results are cached apart
+    # from full /analyze results; a full result is still the better one to reuse
+    datas = [None] * len(urls)
+    pending = []
+    for i, (subtitle_text, _) in enumerate(subs):
+        if subtitle_text:
+            key = _cache_key(mode, subtitle_text)
+            datas[i] = _cache_load("claude", key) or _cache_load("claude_batch", key)
+            if datas[i] is None:
+                pending.append(i)
+
+    if pending:
+        results = call_claude_batch([subs[i][0] for i in pending], api_key, mode=mode)
+        for i, data in zip(pending, results):
+            datas[i] = data
+            if isinstance(data, dict):
+                _cache_store("claude_batch", _cache_key(mode, subs[i][0]), data)
+
+    payloads = []
+    for url, (subtitle_text, title), data in zip(urls, subs, datas):
+        if not subtitle_text:
+            payloads.append({"url": url, "error": NO_SUBTITLES_ERROR})
+        elif not isinstance(data, dict):
+            payloads.append({"url": url, "error": f"AI 分析失敗：{BAD_RESULT_ERROR}"})
+        else:
+            payloads.append({"url": url, **_analysis_payload(title, data, mode)})
+    return payloads
+
+
+@app.route("/analyze_batch", methods=["POST"])
+def analyze_batch():
+    body = request.get_json(silent=True) or {}
+    urls = body.get("urls") or []
+    api_key = get_api_key(body)
+    mode = body.get("mode", "anime")
+
+    if not isinstance(urls, list):
+        return ojsonify({"error": "urls 必須是陣列"}), 400
+    error = _validate_request(urls, api_key)
+    if error:
+        return error
+    if len(urls) > MAX_BATCH_URLS:
+        return ojsonify({"error": f"一次最多 {MAX_BATCH_URLS} 個網址"}), 400
+
+    try:
+        results = _analyze_batch([u.strip() for u in urls], api_key, mode)
+    except Exception as e:
+        error, status = _claude_error(e)
+        return ojsonify(error), status
+
+    resp = ojsonify({"mode": mode, "results": results})
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.route("/download/<key>.nihongocards")
+def download_cards(key):
+    # Keys are SHA-256 hex digests; anything else can't name a cache file
+    path = _cache_path("cards", key)
+    if not re.fullmatch(r"[0-9a-f]{64}", key) or not path.exists():
+        return ojsonify({"error": "檔案已過期，請重新分析。"}), 404
+    # Name direct GETs (outside the page's <a download>) after the stored deck's title
+    name = _safe_filename((_cache_load("cards", key) or {}).get("title", "")) or "AnimeJapanese"
+    return send_file(path, mimetype="application/json", conditional=True,
+                     as_attachment=True, download_name=f"{name}.nihongocards")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 /* AnimeJapanese - Frontend Script */
 
 const LS_KEY = "animejapanese_api_key";
-let currentCards = null;
+let currentDownload = null;
 let currentMode = "anime";
 
 function setMode(mode) {
@@ -77,7 +77,7 @@ async function analyze() {
         return;
       }
 
-      currentCards = data.nihongocards;
+      currentDownload = data;
       showStatus("✅ 完成！");
       setTimeout(clearStatus, 1500);
       renderResults(data);
@@ -156,13 +156,17 @@ function renderResults(data) {
 
 // ── Download ──────────────────────────────────────────
 function downloadCards() {
-  if (!currentCards) return;
-  const json = JSON.stringify(currentCards, null, 2);
-  const blob = new Blob([json], { type: "application/json" });
-  const url = URL.createObjectURL(blob);
+  if (!currentDownload) return;
+  // Served from /download/...; if the server couldn't store the file, the cards come inline
+  let url = currentDownload.download_url;
+  let blobUrl = null;
+  if (!url) {
+    const json = JSON.stringify(currentDownload.nihongocards, null, 2);
+    blobUrl = url = URL.createObjectURL(new Blob([json], { type: "application/json" }));
+  }
   const a = document.createElement("a");
   a.href = url;
-  const safeName = (currentCards.title || "AnimeJapanese")
+  const safeName = `AnimeJapanese - ${currentDownload.title || ""}`
     .replace(/[^a-zA-Z0-9\u3040-\u9fff\s-]/g, "")
     .trim()
     .replace(/\s+/g, "_")
@@ -171,7 +175,7 @@ function downloadCards() {
   document.body.appendChild(a);
   a.click();
   document.body.removeChild(a);
-  URL.revokeObjectURL(url);
+  if (blobUrl) URL.revokeObjectURL(blobUrl);
 }
 
 // ── UI helpers ────────────────────────────────────────
@@ -6,10 +6,14 @@ import json
 import os
 import sys
 import tempfile
+import threading
 import unittest
+import urllib.parse
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
+import anthropic
+
 # Add parent dir to path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
@@ -22,8 +26,8 @@ from app import app, build_nihongocards, parse_subtitle_file
 # ─────────────────────────────────────────────
 
 class TestParseSubtitleFile(unittest.TestCase):
-    def _write_vtt(self, content):
-        f = tempfile.NamedTemporaryFile(suffix=".vtt", mode="w", delete=False, encoding="utf-8")
+    def _write_vtt(self, content, suffix=".vtt"):
+        f = tempfile.NamedTemporaryFile(suffix=suffix, mode="w", delete=False, encoding="utf-8")
         f.write(content)
         f.close()
         return f.name
@@ -69,6 +73,73 @@ class TestParseSubtitleFile(unittest.TestCase):
         self.assertNotIn("<c>", text)
         os.unlink(path)
 
+    def test_collapses_auto_caption_cascade(self):
+        path = self._write_vtt("""WEBVTT
+
+00:00:01.000 --> 00:00:02.000
+今日は<00:00:01.500><c>いい</c>
+
+00:00:02.000 --> 00:00:03.000
+今日はいい
+今日はいい<00:00:02.500><c>天気</c>
+
+00:00:03.000 --> 00:00:04.000
+今日はいい天気
+""")
+        text = parse_subtitle_file(path)
+        self.assertEqual(text, "今日はいい天気")
+        os.unlink(path)
+
+    def test_official_vtt_keeps_prefix_lines(self):
+        path = self._write_vtt("""WEBVTT
+
+00:00:01.000 --> 00:00:02.000
+会いたい
+
+00:00:02.000 --> 00:00:03.000
+会いたいよ
+
+00:00:03.000 --> 00:00:04.000
+そうだ
+
+00:00:04.000 --> 00:00:05.000
+そう
+""")
+        text = parse_subtitle_file(path)
+        self.assertEqual(text, "会いたい\n会いたいよ\nそうだ\nそう")
+        os.unlink(path)
+
+    def test_skips_header_metadata_and_cue_ids(self):
+        path = self._write_vtt("""WEBVTT
+Kind: captions
+Language: ja
+
+1
+00:00:01.000 --> 00:00:02.000 align:start position:0%
+せりふ
+""")
+        text = parse_subtitle_file(path)
+        self.assertEqual(text, "せりふ")
+        os.unlink(path)
+
+    def test_vtt_with_bom(self):
+        path = self._write_vtt("\ufeffWEBVTT\nKind: captions\n\n00:00:01.000 --> 00:00:02.000\nはじめまして\n")
+        self.assertEqual(parse_subtitle_file(path), "はじめまして")
+        os.unlink(path)
+
+    def test_basic_srt(self):
+        path = self._write_vtt("""1
+00:00:01,000 --> 00:00:03,000
+<i>行くぞ</i>
+
+2
+00:00:04,000 --> 00:00:06,000
+待って！
+""", suffix=".srt")
+        text = parse_subtitle_file(path)
+        self.assertEqual(text, "行くぞ\n待って！")
+        os.unlink(path)
+
     def test_empty_vtt(self):
         path = self._write_vtt("WEBVTT\n\n")
         text = parse_subtitle_file(path)
@@ -76,6 +147,31 @@ class TestParseSubtitleFile(unittest.TestCase):
         os.unlink(path)
 
 
+class TestDownloadSubtitles(unittest.TestCase):
+    @patch("app.YoutubeDL")
+    def test_reads_requested_subtitle_path(self, mock_ydl_cls):
+        tmpdir = tempfile.mkdtemp()
+        sub_path = os.path.join(tmpdir, "テストアニメ.ja.vtt")
+        with open(sub_path, "w", encoding="utf-8") as f:
+            f.write("WEBVTT\n\n00:00:01.000 --> 00:00:02.000\nこんにちは\n")
+        ydl = mock_ydl_cls.return_value.__enter__.return_value
+        ydl.extract_info.return_value = {
+            "title": "テストアニメ",
+            "requested_subtitles": {"ja": {"ext": "vtt", "filepath": sub_path}},
+        }
+        text, title = app_module.download_subtitles("https://www.youtube.com/watch?v=x", tmpdir)
+        self.assertEqual(text, "こんにちは")
+        self.assertEqual(title, "テストアニメ")
+
+    @patch("app.YoutubeDL")
+    def test_no_subtitles_returns_none(self, mock_ydl_cls):
+        ydl = mock_ydl_cls.return_value.__enter__.return_value
+        ydl.extract_info.return_value = {"title": "x", "requested_subtitles": None}
+        self.assertEqual(
+            app_module.download_subtitles("https://www.youtube.com/watch?v=x", tempfile.mkdtemp()),
+            (None, None))
+
+
 # ─────────────────────────────────────────────
 # 2. Unit: .nihongocards Builder
 # ─────────────────────────────────────────────
@@ -120,13 +216,205 @@ class TestBuildNihongocards(unittest.TestCase):
 
 
 # ─────────────────────────────────────────────
-# 3. Integration: Flask API Endpoints
+# 3. Unit: Claude Call (mocked client)
+# ─────────────────────────────────────────────
+
+def _claude_message(text):
+    return MagicMock(content=[MagicMock(text=text)])
+
+
+class TestCallClaude(unittest.TestCase):
+    PAYLOAD = {"vocabulary": [{"japanese": "鬼"}], "grammar": []}
+
+    def setUp(self):
+        app_module._get_client.cache_clear()
+
+    @patch("app.anthropic.Anthropic")
+    def test_client_reused_per_api_key(self, mock_cls):
+        self.assertIs(app_module._get_client("sk-ant-a"), app_module._get_client("sk-ant-a"))
+        app_module._get_client("sk-ant-b")
+        self.assertEqual(mock_cls.call_count, 2)
+        # Retries go through the limiter-aware loop, never the SDK's own
+        self.assertEqual(mock_cls.call_args.kwargs["max_retries"], 0)
+
+    @patch("app.anthropic.Anthropic")
+    def test_strips_json_fence(self, mock_cls):
+        fenced = "```json\n" + json.dumps(self.PAYLOAD, ensure_ascii=False) + "\n```"
+        mock_cls.return_value.messages.create.return_value = _claude_message(fenced)
+        self.assertEqual(app_module.call_claude("字幕", "sk-ant-test"), self.PAYLOAD)
+
+    def test_system_prompt_marked_for_caching(self):
+        req = app_module._claude_request("字幕", mode="song")
+        self.assertEqual(req["system"][0]["text"], app_module.SYSTEM_PROMPT_SONG)
+        self.assertEqual(req["system"][0]["cache_control"], {"type": "ephemeral"})
+
+    @patch("app.time.sleep")
+    @patch("app.anthropic.Anthropic")
+    def test_retries_after_rate_limit(self, mock_cls, mock_sleep):
+        rate_limited = anthropic.RateLimitError("rate limited", response=MagicMock(), body=None)
+        mock_cls.return_value.messages.create.side_effect = [
+            rate_limited, _claude_message(json.dumps(self.PAYLOAD))]
+        with patch.object(app_module, "_limiter", app_module._RateLimiter()) as limiter:
+            self.assertEqual(app_module.call_claude("字幕", "sk-ant-test"), self.PAYLOAD)
+            self.assertLess(limiter.scale, 1.0)
+        mock_sleep.assert_called_once_with(30.0)
+
+
+class TestFitSubtitle(unittest.TestCase):
+    def test_short_text_unchanged(self):
+        text = "おはよう\nこんにちは"
+        self.assertEqual(app_module._fit_subtitle(text), text)
+
+    def test_truncates_on_line_boundary(self):
+        lines = [f"第{i}行目のせりふです" for i in range(2000)]
+        result = app_module._fit_subtitle("\n".join(lines), max_tokens=100)
+        kept = result.splitlines()
+        self.assertEqual(kept[-1], "...(字幕截斷)")
+        self.assertTrue(set(kept[:-1]) <= set(lines))
+        self.assertLessEqual(app_module._approx_tokens("".join(kept[:-1])), 100)
+
+    def test_drops_overrepresented_lines_when_over_budget(self):
+        text = "\n".join(["おい"] * 5 + ["まだだ"])
+        result = app_module._fit_subtitle(text, max_tokens=8)
+        self.assertEqual(result.splitlines().count("おい"), 3)
+        self.assertIn("まだだ", result)
+
+
+class TestChunkedAnalysis(unittest.TestCase):
+    def test_split_respects_target_and_overlap(self):
+        lines = [f"第{i:04d}行目のせりふ" for i in range(300)]
+        chunks = app_module._split_by_tokens("\n".join(lines), target=300, overlap=30)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(app_module._approx_tokens(chunk), 300)
+        # Each chunk starts with the tail of the previous one
+        for prev, nxt in zip(chunks, chunks[1:]):
+            self.assertIn(prev.splitlines()[-1], nxt.splitlines())
+        covered = set("\n".join(chunks).splitlines())
+        self.assertEqual(covered, set(lines))
+
+    def test_chunk_request_keeps_every_line(self):
+        # Short lines make the newlines a sizable share of each chunk
+        text = "\n".join(f"せりふ{i:05d}" for i in range(3000))
+        chunks = app_module._split_by_tokens(text)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            content = app_module._claude_request(chunk)["messages"][0]["content"]
+            for line in chunk.splitlines():
+                self.assertIn(line, content)
+            self.assertNotIn("字幕截斷", content)
+
+    def test_merge_dedupes_and_ranks_by_frequency(self):
+        results = [
+            {"vocabulary": [{"japanese": "鬼"}, {"japanese": "刀"}],
+             "grammar": [{"japanese": "A"}, {"japanese": "B"}]},
+            {"vocabulary": [{"japanese": "刀"}, {"japanese": "呼吸"}],
+             "grammar": [{"japanese": "C"}]},
+        ]
+        merged = app_module._merge_results(results, "呼吸 呼吸 呼吸 刀 刀 鬼")
+        self.assertEqual([v["japanese"] for v in merged["vocabulary"]], ["呼吸", "刀", "鬼"])
+        self.assertEqual([g["japanese"] for g in merged["grammar"]], ["A", "C", "B"])
+
+    @patch("app._call_claude_once")
+    def test_long_transcript_is_chunked(self, mock_once):
+        mock_once.return_value = {"vocabulary": [{"japanese": "鬼"}], "grammar": []}
+        text = "\n".join(f"第{i:05d}行目のせりふです" for i in range(1500))
+        result = app_module.call_claude(text, "sk-ant-test")
+        self.assertGreater(mock_once.call_count, 1)
+        self.assertLessEqual(mock_once.call_count, app_module._MAX_CHUNKS)
+        self.assertEqual(result["vocabulary"], [{"japanese": "鬼"}])
+
+    @patch("app._call_claude_once", return_value={"vocabulary": [], "grammar": []})
+    def test_chunks_past_cap_are_marked_truncated(self, mock_once):
+        text = "\n".join(f"第{i:05d}行目のせりふです" for i in range(5000))
+        with self.assertLogs(app.logger, level="WARNING"):
+            app_module.call_claude(text, "sk-ant-test")
+        self.assertEqual(mock_once.call_count, app_module._MAX_CHUNKS)
+        self.assertTrue(any(c.args[0].endswith("...(字幕截斷)") for c in mock_once.call_args_list))
+
+
+class TestCoalesced(unittest.TestCase):
+    def test_concurrent_callers_share_one_run(self):
+        started, waiting, release = threading.Event(), threading.Event(), threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"ok": True}, 200
+
+        # Only the follower waits on the shared future; signal once it gets there
+        future_result = app_module.Future.result
+
+        def result(future, *args, **kwargs):
+            waiting.set()
+            return future_result(future, *args, **kwargs)
+
+        results = []
+        with patch.object(app_module.Future, "result", result):
+            leader = threading.Thread(target=lambda: results.append(app_module._coalesced("k", work)))
+            leader.start()
+            started.wait(5)
+            follower = threading.Thread(target=lambda: results.append(app_module._coalesced("k", work)))
+            follower.start()
+            self.assertTrue(waiting.wait(5))
+            release.set()
+            leader.join(5)
+            follower.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [({"ok": True}, 200)] * 2)
+        self.assertEqual(app_module._inflight, {})
+
+    def test_exception_propagates_and_clears_entry(self):
+        with self.assertRaises(RuntimeError):
+            app_module._coalesced("k", lambda: (_ for _ in ()).throw(RuntimeError("boom")))
+        self.assertEqual(app_module._inflight, {})
+
+
+class TestEstimateTokens(unittest.TestCase):
+    def test_uses_input_budget_scale(self):
+        text = "あ" * 7200  # 6000 tokens at 1.2 chars/token
+        req = app_module._claude_request(text)
+        self.assertGreaterEqual(app_module._estimate_tokens(req), 6000 + req["max_tokens"])
+
+    def test_batch_counts_output_for_every_block(self):
+        req = app_module._claude_batch_request(["字幕"] * 5)
+        self.assertGreaterEqual(app_module._estimate_tokens(req), 4096 * 5)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_blocks_after_rpm_reached(self):
+        limiter = app_module._RateLimiter(rpm=2, tpm=100_000)
+        self.assertEqual(limiter._try_reserve(10), 0.0)
+        self.assertEqual(limiter._try_reserve(10), 0.0)
+        self.assertGreater(limiter._try_reserve(10), 0.0)
+
+    def test_blocks_when_token_budget_exceeded(self):
+        limiter = app_module._RateLimiter(rpm=50, tpm=1000)
+        self.assertEqual(limiter._try_reserve(800), 0.0)
+        self.assertGreater(limiter._try_reserve(800), 0.0)
+
+    def test_acquire_releases_concurrency_slot(self):
+        limiter = app_module._RateLimiter(max_concurrent=1)
+        with limiter.acquire(10):
+            self.assertGreater(limiter._try_reserve(10), 0.0)
+        self.assertEqual(limiter._active, 0)
+
+
+# ─────────────────────────────────────────────
+# 4. Integration: Flask API Endpoints
 # ─────────────────────────────────────────────
 
 class TestFlaskEndpoints(unittest.TestCase):
     def setUp(self):
         app.config["TESTING"] = True
         self.client = app.test_client()
+        # Isolate the on-disk cache per test
+        cache_patch = patch.object(app_module, "_CACHE_DIR", Path(tempfile.mkdtemp()))
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
 
     def test_index_returns_html(self):
         resp = self.client.get("/")
@@ -185,15 +473,133 @@ class TestFlaskEndpoints(unittest.TestCase):
         self.assertEqual(data["title"], "テストアニメ")
         self.assertEqual(len(data["vocabulary"]), 1)
         self.assertEqual(len(data["grammar"]), 1)
-        self.assertIn("nihongocards", data)
-        # Verify .nihongocards structure
-        nc = data["nihongocards"]
+        self.assertNotIn("nihongocards", data)
+        # Verify .nihongocards structure served from the download URL
+        dl = self.client.get(data["download_url"])
+        self.assertEqual(dl.status_code, 200)
+        nc = dl.get_json()
+        self.assertIn("AnimeJapanese_-_テストアニメ.nihongocards",
+                      urllib.parse.unquote(dl.headers["Content-Disposition"]))
         self.assertEqual(nc["version"], 1)
         self.assertEqual(len(nc["tables"]), 2)
+        # ETag support: an unchanged file is not sent again
+        again = self.client.get(data["download_url"], headers={"If-None-Match": dl.headers["ETag"]})
+        self.assertEqual(again.status_code, 304)
+
+    def test_download_unknown_key(self):
+        resp = self.client.get("/download/" + "0" * 64 + ".nihongocards")
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get("/download/..%2Fsecret.nihongocards")
+        self.assertEqual(resp.status_code, 404)
+
+    @patch("app.call_claude", side_effect=lambda *a, **k: app_module.orjson.loads("{bad"))
+    @patch("app.download_subtitles", return_value=("字幕テキスト", "テストアニメ"))
+    def test_analyze_bad_claude_json(self, mock_dl, mock_claude):
+        resp = self.client.post("/analyze",
+            json={"url": "https://www.youtube.com/watch?v=badjson", "api_key": "sk-ant-test"})
+        self.assertEqual(resp.status_code, 500)
+        self.assertIn("格式解析失敗", resp.get_json()["error"])
+
+    @patch("app.call_claude", return_value=[{"a": 1}])
+    @patch("app.download_subtitles", return_value=("字幕テキスト", "テストアニメ"))
+    def test_analyze_non_object_result_not_cached(self, mock_dl, mock_claude):
+        payload = {"url": "https://www.youtube.com/watch?v=notdict", "api_key": "sk-ant-test"}
+        first = self.client.post("/analyze", json=payload)
+        self.assertEqual(first.status_code, 500)
+        self.assertIn("error", first.get_json())
+        # The bad reply isn't cached, so a retry asks Claude again
+        mock_claude.return_value = {"vocabulary": [], "grammar": []}
+        second = self.client.post("/analyze", json=payload)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(mock_claude.call_count, 2)
+
+    @patch("app.call_claude", return_value={"vocabulary": [], "grammar": []})
+    @patch("app.download_subtitles", return_value=("字幕テキスト", "テストアニメ"))
+    def test_analyze_repeat_url_uses_cache(self, mock_dl, mock_claude):
+        payload = {"url": "https://www.youtube.com/watch?v=cached", "api_key": "sk-ant-test"}
+        first = self.client.post("/analyze", json=payload)
+        second = self.client.post("/analyze", json=payload)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.get_json()["title"], first.get_json()["title"])
+        mock_dl.assert_called_once()
+        mock_claude.assert_called_once()
+
+    @patch("app.call_claude_batch")
+    @patch("app.download_subtitles")
+    def test_analyze_batch(self, mock_dl, mock_batch):
+        subs = {
+            "https://www.youtube.com/watch?v=ep1": ("第一話の字幕", "第1話"),
+            "https://www.youtube.com/watch?v=ep2": (None, None),
+            "https://www.youtube.com/watch?v=ep3": ("第三話の字幕", "第3話"),
+        }
+        mock_dl.side_effect = lambda url, tmpdir: subs[url]
+        mock_batch.return_value = [
+            {"vocabulary": [{"japanese": "一"}], "grammar": []},
+            {"vocabulary": [{"japanese": "三"}], "grammar": []},
+        ]
+        resp = self.client.post("/analyze_batch",
+            json={"urls": list(subs), "api_key": "sk-ant-test"})
+        self.assertEqual(resp.status_code, 200)
+        results = resp.get_json()["results"]
+        self.assertEqual([r.get("title") for r in results], ["第1話", None, "第3話"])
+        self.assertIn("字幕", results[1]["error"])
+        self.assertEqual(results[2]["vocabulary"][0]["japanese"], "三")
+        # One Claude request covering only the videos that had subtitles
+        mock_batch.assert_called_once()
+        self.assertEqual(mock_batch.call_args.args[0], ["第一話の字幕", "第三話の字幕"])
+
+    @patch("app.call_claude_batch", return_value=["oops"])
+    @patch("app.download_subtitles", return_value=("字幕", "第1話"))
+    def test_analyze_batch_non_object_result_not_cached(self, mock_dl, mock_batch):
+        payload = {"urls": ["https://www.youtube.com/watch?v=oops"], "api_key": "sk-ant-test"}
+        result = self.client.post("/analyze_batch", json=payload).get_json()["results"][0]
+        self.assertIn("error", result)
+        self.client.post("/analyze_batch", json=payload)
+        self.assertEqual(mock_batch.call_count, 2)
+
+    @patch("app.call_claude", return_value={"vocabulary": [{"japanese": "全"}], "grammar": []})
+    @patch("app.call_claude_batch",
+           return_value=[{"vocabulary": [{"japanese": "略"}], "grammar": []}])
+    @patch("app.download_subtitles", return_value=("字幕", "第1話"))
+    def test_batch_result_not_reused_by_analyze(self, mock_dl, mock_batch, mock_claude):
+        url = "https://www.youtube.com/watch?v=shared"
+        self.client.post("/analyze_batch", json={"urls": [url], "api_key": "sk-ant-test"})
+        resp = self.client.post("/analyze", json={"url": url, "api_key": "sk-ant-test"})
+        self.assertEqual(resp.get_json()["vocabulary"][0]["japanese"], "全")
+        mock_claude.assert_called_once()
+
+    @patch("app.download_subtitles", side_effect=lambda url, tmpdir: (f"字幕 {url}", "第1話"))
+    def test_concurrent_batches(self, mock_dl):
+        # Both requests must be inside the Claude call at once for the barrier to open
+        barrier = threading.Barrier(2, timeout=5)
+
+        def batch(texts, api_key, mode):
+            barrier.wait()
+            return [{"vocabulary": [], "grammar": []} for _ in texts]
+
+        statuses = []
+
+        def post(i):
+            resp = app_module.app.test_client().post("/analyze_batch", json={
+                "urls": [f"https://www.youtube.com/watch?v=c{i}"], "api_key": "sk-ant-test"})
+            statuses.append(resp.status_code)
+
+        with patch("app.call_claude_batch", side_effect=batch):
+            threads = [threading.Thread(target=post, args=(i,)) for i in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(statuses, [200, 200])
+
+    def test_analyze_batch_too_many_urls(self):
+        urls = [f"https://www.youtube.com/watch?v={i}" for i in range(app_module.MAX_BATCH_URLS + 1)]
+        resp = self.client.post("/analyze_batch", json={"urls": urls, "api_key": "sk-ant-test"})
+        self.assertEqual(resp.status_code, 400)
 
 
 # ─────────────────────────────────────────────
-# 4. Integration: Real YouTube Subtitle Download
+# 5. Integration: Real YouTube Subtitle Download
 #    (Skipped in CI — requires Chrome cookies + network)
 # ─────────────────────────────────────────────
 
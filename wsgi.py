@@ -0,0 +1,10 @@
+"""WSGI entry point for running AnimeJapanese under gunicorn's gevent worker.
+
+    gunicorn -k gevent -w 4 --worker-connections 100 -b 0.0.0.0:5001 wsgi:app
+"""
+
+# Patch sockets/threads before anything imports httpx or yt-dlp
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402